@@ -9,15 +9,49 @@
 import os
 import sys
 import shutil
+import stat
 import json
 import re
 import argparse
+import socket
+import time
+import fcntl
+import threading
+import concurrent.futures
+import urllib.request
+import urllib.parse
 import datetime as dt
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import PyMongoError, DuplicateKeyError, CollectionInvalid
+
+class aqfcdbError(Exception):
+    """
+      Raised by the managers for any condition that stops a run (bad configuration, missing model
+      output, database unavailable, ...).  The message is what the command line prints before exiting.
+    """
+    pass
 
 class runManager(object):
-    def __init__(self):
+    """
+      cfgFile : JSON configuration file, only read if 'cfgData' (already loaded configuration) isn't given
+      dbuname : Remote database username
+      dbpword : Remote database password
+    """
+    def __init__(self, cfgFile, dbuname, dbpword, cfgData=None):
+
+        self.cfgFile = cfgFile
+        self.dbuname = dbuname
+        self.dbpword = dbpword
+        if cfgData is not None:
+            self.prg_cfgdata = cfgData
 
+        self.setDTstamp()
+
+    """
+      setDTstamp : Stamp the current run with the current date/time.  Called on creation and
+      again at the start of each pipeline run, since the run dates are relative to it.
+    """
+    def setDTstamp(self):
         self.dtStamp = dt.datetime.now()
         self.dtStamp = self.dtStamp.replace(microsecond=0)
 
@@ -29,28 +63,15 @@ class runManager(object):
         self.maxMon  = self.dtStamp.strftime("%m")
         self.maxDay  = self.dtStamp.strftime("%d")
 
-        self.setCmdLineArgs()
-
     def setLogFH(self):
         try:
             self.logfh = open(self.prg_cfgdata["RunInformation"]["logfile"], 'a+')
         except IOError:
-            print("\t***ERROR: Could not open run report file ({})\n".format(fname))
-            raise SystemExit
+            raise aqfcdbError("\t***ERROR: Could not open run report file ({})\n".format(self.prg_cfgdata["RunInformation"]["logfile"]))
 
     def getLogFH(self):
         return (self.logfh)
 
-    def setCmdLineArgs(self):
-        parser = argparse.ArgumentParser()
-        parser.add_argument("cfgfile", help="Your input configuration File (JSON format)", type=str)
-        parser.add_argument("-u", "--uname", help="Remote database username",type=str)
-        parser.add_argument("-p", "--pword", help="Remote database password",type=str)
-        args = parser.parse_args()
-        self.cfgFile = args.cfgfile
-        self.dbuname = args.uname
-        self.dbpword = args.pword
-    
     def getDTstamp(self):
         return(self.dtStamp)
     
@@ -87,6 +108,42 @@ class runManager(object):
     def getMaxRetro(self):
         return(self.prg_cfgdata["RunInformation"]["maxretrodays"])
 
+    def getLeaseBackend(self):
+        return(self.prg_cfgdata["RunInformation"]["leasebackend"])
+
+    def getLeaseTTL(self):
+        return(self.prg_cfgdata["RunInformation"]["leasettl"])
+
+    def getLeaseWait(self):
+        return(self.prg_cfgdata["RunInformation"]["leasewait"])
+
+    def getLockDir(self):
+        return(self.prg_cfgdata["RunInformation"]["lockdir"])
+
+    def getEventSink(self):
+        return(self.prg_cfgdata["RunInformation"]["eventsink"])
+
+    def getEventTarget(self):
+        return(self.prg_cfgdata["RunInformation"]["eventtarget"])
+
+    def getEventCapSize(self):
+        return(self.prg_cfgdata["RunInformation"]["eventcapsize"])
+
+    def getIOMaxBytes(self):
+        return(self.prg_cfgdata["RunInformation"]["iomaxbytespersec"])
+
+    def getIOMaxOps(self):
+        return(self.prg_cfgdata["RunInformation"]["iomaxopspersec"])
+
+    def getIOMaxConcurrent(self):
+        return(self.prg_cfgdata["RunInformation"]["iomaxconcurrent"])
+
+    def getIOLatencyTarget(self):
+        return(self.prg_cfgdata["RunInformation"]["iolatencytarget"])
+
+    def getIOReadTarget(self):
+        return(self.prg_cfgdata["RunInformation"]["ioreadtarget"])
+
     def setProgramPath(self):
         self.programPath = os.getcwd()
 
@@ -106,10 +163,10 @@ class runManager(object):
         try:
             self.cfgfh = open(self.cfgFile, 'r')
         except IOError:
-            print("\t***ERROR: Could not open JSON Configuration File ({})\n".format(self.cfgFile))
-            raise SystemExit
+            raise aqfcdbError("\t***ERROR: Could not open JSON Configuration File ({})\n".format(self.cfgFile))
         
         self.prg_cfgdata = json.load(self.cfgfh)
+        self.cfgfh.close()
 
     def writeCfgData(self):
             
@@ -125,9 +182,20 @@ class runManager(object):
         self.logfh.write("\t\tRun Prefix: {}\n".format(self.prg_cfgdata["RunInformation"]["runprefix"]))
         self.logfh.write("\t\t# of Retro Days : {}\n".format(self.prg_cfgdata["RunInformation"]["nretrodays"]))
         self.logfh.write("\t\tMax # Retro Days: {}\n".format(self.prg_cfgdata["RunInformation"]["maxretrodays"]))
+        self.logfh.write("\t\tLease Backend: {}\n".format(self.prg_cfgdata["RunInformation"]["leasebackend"]))
+        self.logfh.write("\t\tLease TTL (s): {}\n".format(self.prg_cfgdata["RunInformation"]["leasettl"]))
+        self.logfh.write("\t\tLease Wait (s): {}\n".format(self.prg_cfgdata["RunInformation"]["leasewait"]))
+        self.logfh.write("\t\tLock Directory: {}\n".format(self.prg_cfgdata["RunInformation"]["lockdir"]))
+        self.logfh.write("\t\tEvent Sink: {}\n".format(self.prg_cfgdata["RunInformation"]["eventsink"]))
+        self.logfh.write("\t\tEvent Target: {}\n".format(self.prg_cfgdata["RunInformation"]["eventtarget"]))
+        self.logfh.write("\t\tNetApp Max Bytes/sec: {}\n".format(self.prg_cfgdata["RunInformation"]["iomaxbytespersec"]))
+        self.logfh.write("\t\tNetApp Max Ops/sec: {}\n".format(self.prg_cfgdata["RunInformation"]["iomaxopspersec"]))
+        self.logfh.write("\t\tNetApp Max Concurrent: {}\n".format(self.prg_cfgdata["RunInformation"]["iomaxconcurrent"]))
+        self.logfh.write("\t\tNetApp Metadata Latency Target (s): {}\n".format(self.prg_cfgdata["RunInformation"]["iolatencytarget"]))
+        self.logfh.write("\t\tNetApp Read Latency Target (s/MiB): {}\n".format(self.prg_cfgdata["RunInformation"]["ioreadtarget"]))
 
     def validateMandate(self):
-        runlog.write("\t[INFO]: Checking manual date...\n")
+        self.logfh.write("\t[INFO]: Checking manual date...\n")
         syr = self.prg_cfgdata["RunInformation"]["mandate"]["year"]
         smo = self.prg_cfgdata["RunInformation"]["mandate"]["month"]
         sdy = self.prg_cfgdata["RunInformation"]["mandate"]["day"]
@@ -135,60 +203,305 @@ class runManager(object):
         try:
             runDate = dt.datetime(year=syr, month=smo, day=sdy)
         except ValueError:
-            print("\t***ERROR: Bad simulation date, check rundate in JSON config file.\n")
-            raise SystemExit
+            raise aqfcdbError("\t***ERROR: Bad simulation date, check rundate in JSON config file.\n")
 
         if (runDate > self.dtStamp):
-            print("\t***ERROR: The simulation run date cannot be past the current date\n")
-            raise SystemExit
+            raise aqfcdbError("\t***ERROR: The simulation run date cannot be past the current date\n")
 
         minYr = self.prg_cfgdata["RunInformation"]["minrunyear"]
 
         if (syr < minYr):
-            print("\t***ERROR: Simulation year < {}, check project start\n".format(minYr))
-            raise SystemExit
+            raise aqfcdbError("\t***ERROR: Simulation year < {}, check project start\n".format(minYr))
         
-        runlog.write("\t[STAT]: Ok.\n")
+        self.logfh.write("\t[STAT]: Ok.\n")
     
     def validateRetro(self):
-        runlog.write("\t[INFO]: Checking # retrospective days...\n")
+        self.logfh.write("\t[INFO]: Checking # retrospective days...\n")
         if (self.prg_cfgdata["RunInformation"]["nretrodays"] < 0 or
             self.prg_cfgdata["RunInformation"]["nretrodays"] > self.prg_cfgdata["RunInformation"]["maxretrodays"]):
-            print("\t***ERROR: # retrospective simulation days < 0 or > maximum # allowed, check JSON config file.\n")
-            raise SystemExit
-        runlog.write("\t[STAT]: Ok.\n")
+            raise aqfcdbError("\t***ERROR: # retrospective simulation days < 0 or > maximum # allowed, check JSON config file.\n")
+        self.logfh.write("\t[STAT]: Ok.\n")
 
     def validatePyEnv(self):
-        runlog.write("\t[INFO]: Checking Python Environment...\n")
+        self.logfh.write("\t[INFO]: Checking Python Environment...\n")
         os.system('which python > ./python_env')
         try:
             efile = open('./python_env','r')
         except IOError:
-            print("\t***ERROR: Couldn't open Python environment file ./python_env\n")
-            raise SystemExit
+            raise aqfcdbError("\t***ERROR: Couldn't open Python environment file ./python_env\n")
 
         pyStr = efile.read()
         efile.close()
         m = re.search('aqfcdb',pyStr)
         if(not m):
-            print("\t***ERROR: You are not in the correct conda environment (aqfcdb)\n")
-            raise SystemExit
-        runlog.write("\t[STAT]: Ok.\n")
+            raise aqfcdbError("\t***ERROR: You are not in the correct conda environment (aqfcdb)\n")
+        self.logfh.write("\t[STAT]: Ok.\n")
+
+class ioManager(object):
+
+    CHUNKSIZE = 1048576    # bytes read from the NetApp per copy chunk
+    MINREAD   = 65536      # reads smaller than this are dominated by per-call overhead, not timed
+    MINSCALE  = 0.05       # never throttle below 5% of the configured ceilings
+    CACHEAGE  = 60         # seconds a directory must be unmodified before its listing is cached
+
+    def __init__(self, runMgr, runlog):
+        """
+          maxBytes      : Ceiling on NetApp read bytes/sec (0 is unlimited)
+          maxOps        : Ceiling on NetApp listing/stat/open operations per second (0 is unlimited)
+          maxConcurrent : Ceiling on the # of NetApp operations in flight at once (files of a forecast
+                          are copied in parallel), must be at least 1
+          metaTarget    : Listing/stat latency (seconds) we consider healthy, this reflects how busy
+                          the NetApp itself is
+          readTarget    : Read latency (seconds per MiB) we consider healthy, this reflects the
+                          bandwidth left on the mount (including what we use ourselves)
+          scale         : Current fraction (MINSCALE to 1.0) of the rate ceilings we're allowed to use
+          concurrency   : Current # of operations allowed in flight (1 to maxConcurrent)
+          When either smoothed latency climbs over twice its target we halve our rates and drop one
+          concurrent operation, and while both stay under target we creep back up to the ceilings.
+          dirCache      : Directory listings, path -> (mtime, listing), kept across pipeline runs
+        """
+        self.runlog        = runlog
+        self.maxBytes      = runMgr.getIOMaxBytes()
+        self.maxOps        = runMgr.getIOMaxOps()
+        self.maxConcurrent = runMgr.getIOMaxConcurrent()
+        self.metaTarget    = runMgr.getIOLatencyTarget()
+        self.readTarget    = runMgr.getIOReadTarget()
+
+        if self.maxConcurrent < 1:
+            raise aqfcdbError("\t***ERROR: iomaxconcurrent must be at least 1, check JSON config file\n")
+
+        self.scale       = 1.0
+        self.concurrency = self.maxConcurrent
+        self.active      = 0
+        self.metaLatency = None
+        self.readLatency = None
+        self.lock        = threading.Lock()
+        self.slotFree    = threading.Condition(self.lock)
+
+        self.opsClock   = 0.0     # earliest time the next operation may start (ops ceiling)
+        self.bytesClock = 0.0     # earliest time the next read may start (bytes ceiling)
+        self.lastAdjust = 0.0
+
+        self.dirCache   = {}
+        self.dirTouched = set()
+
+        self.resetStats()
+
+    """
+      startRun : Called at the start of each pipeline run.  Listings of directories that weren't
+      looked at during the previous run (run dates that have aged out) are dropped from the cache.
+    """
+    def startRun(self):
+        self.dirCache = { k: v for k, v in self.dirCache.items() if k in self.dirTouched }
+        self.dirTouched = set()
+        self.resetStats()
+
+    def resetStats(self):
+        self.nOps       = 0
+        self.nBytes     = 0
+        self.nBackoffs  = 0
+        self.nCacheHits = 0
+
+    """
+      pace : Charge 'nops' operations and 'nbytes' bytes against the current rates and sleep
+      until we're allowed to go on
+    """
+    def pace(self, nops, nbytes):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.opsClock, self.bytesClock)
+            if self.maxOps > 0:
+                self.opsClock = start + nops / (self.maxOps * self.scale)
+            if self.maxBytes > 0:
+                self.bytesClock = start + nbytes / (self.maxBytes * self.scale)
+            self.nOps   = self.nOps + nops
+            self.nBytes = self.nBytes + nbytes
+            delay = start - now
+
+        if delay > 0:
+            time.sleep(delay)
+
+    """
+      acquireSlot/releaseSlot : Wait for one of the 'concurrency' NetApp operation slots
+    """
+    def acquireSlot(self):
+        with self.slotFree:
+            while self.active >= self.concurrency:
+                self.slotFree.wait()
+            self.active = self.active + 1
+
+    def releaseSlot(self):
+        with self.slotFree:
+            self.active = self.active - 1
+            self.slotFree.notify_all()
+
+    """
+      observeMeta/observeRead : Fold a measured listing/stat latency (seconds), or read latency
+      (normalised to seconds per MiB, so chunk size doesn't matter) into its smoothed latency
+    """
+    def observeMeta(self, latency):
+        with self.lock:
+            self.metaLatency = self.smooth(self.metaLatency, latency)
+            self.adjust()
+
+    def observeRead(self, latency, nbytes):
+        if nbytes < self.MINREAD:
+            return
+        with self.lock:
+            self.readLatency = self.smooth(self.readLatency, latency * self.CHUNKSIZE / nbytes)
+            self.adjust()
+
+    def smooth(self, current, sample):
+        if current is None:
+            return(sample)
+        return(0.8 * current + 0.2 * sample)
+
+    """
+      adjust : Back off (halve the rate scale, one less concurrent operation) when either latency is
+      over twice its target, speed up when both are under target.  Called with 'lock' held, and acts
+      at most once per second so a single slow burst doesn't collapse our rates.
+    """
+    def adjust(self):
+        now = time.monotonic()
+        if now - self.lastAdjust < 1.0:
+            return
+
+        metaSlow = self.metaLatency is not None and self.metaLatency > 2 * self.metaTarget
+        readSlow = self.readLatency is not None and self.readLatency > 2 * self.readTarget
+        metaOk   = self.metaLatency is None or self.metaLatency < self.metaTarget
+        readOk   = self.readLatency is None or self.readLatency < self.readTarget
+
+        if metaSlow or readSlow:
+            if self.scale > self.MINSCALE or self.concurrency > 1:
+                self.scale = max(self.MINSCALE, self.scale * 0.5)
+                self.concurrency = max(1, self.concurrency - 1)
+                self.nBackoffs = self.nBackoffs + 1
+                self.lastAdjust = now
+        elif metaOk and readOk:
+            if self.scale < 1.0 or self.concurrency < self.maxConcurrent:
+                self.scale = min(1.0, self.scale + 0.1)
+                self.concurrency = min(self.maxConcurrent, self.concurrency + 1)
+                self.slotFree.notify_all()
+                self.lastAdjust = now
+
+    """
+      timedOp : Run the listing/stat call 'func(path)' in an operation slot, paced and timed.
+      meteredOp does the same for callers that already hold a slot.
+    """
+    def timedOp(self, func, path):
+        self.acquireSlot()
+        try:
+            return(self.meteredOp(func, path))
+        finally:
+            self.releaseSlot()
+
+    def meteredOp(self, func, path):
+        self.pace(1, 0)
+        t0 = time.monotonic()
+        try:
+            return(func(path))
+        finally:
+            self.observeMeta(time.monotonic() - t0)
+
+    """
+      copyStat : Like shutil.copystat, but the NetApp source is stat'ed only once, through the
+      throttle, and the mode and times are applied from that result
+    """
+    def copyStat(self, srcStat, dst):
+        os.chmod(dst, stat.S_IMODE(srcStat.st_mode))
+        os.utime(dst, ns=(srcStat.st_atime_ns, srcStat.st_mtime_ns))
+
+    """
+      listdir : A stat of the directory is much cheaper on the NetApp than a full listing, so we
+      only re-list a directory whose mtime changed since we cached it.  A listing is only cached
+      once the directory has been quiet for CACHEAGE seconds, so files the model writes within
+      the same mtime tick as our listing are never missed.
+    """
+    def listdir(self, path):
+        self.dirTouched.add(path)
+        st = self.timedOp(os.stat, path)
+        cached = self.dirCache.get(path)
+        if cached is not None and cached[0] == st.st_mtime_ns:
+            self.nCacheHits = self.nCacheHits + 1
+            return(list(cached[1]))
+
+        dList = self.timedOp(os.listdir, path)
+        if time.time() - st.st_mtime > self.CACHEAGE:
+            self.dirCache[path] = (st.st_mtime_ns, dList)
+        else:
+            self.dirCache.pop(path, None)
+        return(list(dList))
+
+    def isdir(self, path):
+        return(self.timedOp(os.path.isdir, path))
+
+    def exists(self, path):
+        return(self.timedOp(os.path.exists, path))
+
+    """
+      copyFile : Throttled replacement for shutil.copy2, reads the source in CHUNKSIZE pieces,
+      timing each read, and paces the next read by the number of bytes just read
+    """
+    def copyFile(self, src, dst):
+        self.acquireSlot()
+        try:
+            self.pace(1, 0)
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                while True:
+                    t0 = time.monotonic()
+                    buf = fsrc.read(self.CHUNKSIZE)
+                    self.observeRead(time.monotonic() - t0, len(buf))
+                    if not buf:
+                        break
+                    fdst.write(buf)
+                    self.pace(0, len(buf))
+            self.copyStat(self.meteredOp(os.stat, src), dst)
+        finally:
+            self.releaseSlot()
+        return(dst)
+
+    """
+      copytree : Throttled replacement for shutil.copytree ('dst' must not exist).  The files of each
+      directory are copied in parallel, up to the current 'concurrency' at a time.
+    """
+    def copytree(self, src, dst):
+        entries = self.timedOp(lambda p: [ (e.name, e.is_dir()) for e in os.scandir(p) ], src)
+        os.makedirs(dst)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.maxConcurrent) as pool:
+            futures = [ pool.submit(self.copyFile, os.path.join(src, name), os.path.join(dst, name))
+                        for name, isDir in entries if not isDir ]
+            for f in futures:
+                f.result()    # re-raises the first copy error
+
+        for name, isDir in entries:
+            if isDir:
+                self.copytree(os.path.join(src, name), os.path.join(dst, name))
+
+        self.copyStat(self.timedOp(os.stat, src), dst)
+        return(dst)
+
+    def writeStats(self):
+        self.runlog.write("\t[INFO]: NetApp I/O: {} ops, {} bytes read, {} cached listings, {} backoffs, final rate scale {:.2f}, concurrency {}\n"
+                     .format(self.nOps, self.nBytes, self.nCacheHits, self.nBackoffs, self.scale, self.concurrency))
 
 class simManager(object):
-    def __init__(self):
+    def __init__(self, runMgr, ioMgr, runlog):
 
-        self.simDir = runMgr.getnetapproot()
-        self.simPre = runMgr.getRunPrefix()
+        self.runMgr = runMgr
+        self.ioMgr  = ioMgr
+        self.runlog = runlog
+        self.simDir = self.runMgr.getnetapproot()
+        self.simPre = self.runMgr.getRunPrefix()
         self.datesList = self.getSimDates()
         self.finalList = [] #contains dates for which simulation plot output directories exist
 
     def getSimDates(self):
         dList = []    # the list of model run dates
-        numRetro = runMgr.getNumRetro()
+        numRetro = self.runMgr.getNumRetro()
 
-        if runMgr.getUseManFlag():
-            cfg = runMgr.getCfgData()
+        if self.runMgr.getUseManFlag():
+            cfg = self.runMgr.getCfgData()
             myr = cfg["RunInformation"]["mandate"]["year"]
             mmo = cfg["RunInformation"]["mandate"]["month"]
             mdy = cfg["RunInformation"]["mandate"]["day"]
@@ -198,7 +511,7 @@ class simManager(object):
             dList.append(manDateStr)
             baseDate = manDate
         else:
-            nowDate = runMgr.getDTstamp()
+            nowDate = self.runMgr.getDTstamp()
             nowDateStr = nowDate.strftime("%Y%m%d")
             dList.append(nowDateStr)
             baseDate = nowDate
@@ -213,16 +526,15 @@ class simManager(object):
         return(dList)
 
     def checkSimEnv(self):
-        runlog.write("\t[INFO]: Checking model simulation directory...\n")
+        self.runlog.write("\t[INFO]: Checking model simulation directory...\n")
 
         # First check to make sure the model simulation directory exists
-        if(not os.path.exists(self.simDir)):
-            print("\t\t***ERROR: Model simulation directory {} does not exist, check JSON config file\n".format(self.simDir))
-            raise SystemExit
+        if(not self.ioMgr.exists(self.simDir)):
+            raise aqfcdbError("\t\t***ERROR: Model simulation directory {} does not exist, check JSON config file\n".format(self.simDir))
         
-        runlog.write("\t[STAT]: Ok.\n")
+        self.runlog.write("\t[STAT]: Ok.\n")
         
-        runlog.write("\t[INFO]: Checking simulation sub-directories...\n")
+        self.runlog.write("\t[INFO]: Checking simulation sub-directories...\n")
         # Next check to make sure all of the plot output sub-directories (dates stored in 'datesList')
         # exist.  If any are missing, we won't abort, but will report in output log file. Also build
         # the "final" list of simulation dates (those where directories exist, but note, may not have
@@ -230,22 +542,21 @@ class simManager(object):
         
         for d in range(len(self.datesList)):
             fullDirPath = self.getFullPath(self.datesList[d])
-            if (not os.path.isdir(fullDirPath)):
-                runlog.write("\t\t[WARN]: Simulation sub-directory {} does not exist, skipping!\n".format(fullDirPath))
+            if (not self.ioMgr.isdir(fullDirPath)):
+                self.runlog.write("\t\t[WARN]: Simulation sub-directory {} does not exist, skipping!\n".format(fullDirPath))
             else:
-                runlog.write("\t\t[STAT]: Simulation sub-directory {} exists, using!\n".format(fullDirPath))
+                self.runlog.write("\t\t[STAT]: Simulation sub-directory {} exists, using!\n".format(fullDirPath))
                 self.finalList.append(self.datesList[d])
 
         if len(self.finalList) == 0:
-            print("\t\t***ERROR: All simulation dates have no corresponding model plot directories\n")
-            raise SystemExit
+            raise aqfcdbError("\t\t***ERROR: All simulation dates have no corresponding model plot directories\n")
         
-        runlog.write("\t[STAT]: Done.\n")
+        self.runlog.write("\t[STAT]: Done.\n")
     
     def getFullPath(self,dateArg):
-        baseDir = runMgr.getnetapproot()
-        prefix  = runMgr.getRunPrefix()
-        suffix  = runMgr.getRunSuffix()
+        baseDir = self.runMgr.getnetapproot()
+        prefix  = self.runMgr.getRunPrefix()
+        suffix  = self.runMgr.getRunSuffix()
         return(baseDir + prefix + dateArg + suffix)
 
     def getDatesList(self):
@@ -335,16 +646,16 @@ class productManager(object):
 
 class processManager(object):
 
-    def __init__(self):
-        pass
+    def __init__(self, runlog):
+        self.runlog = runlog
     
     def collectProduct(self, productInfo, fList, dt):
 
         productList = []   # Array of product filenames
 
-        runlog.write("\t[INFO]: Collecting {} files for {} simulation...\n".format(productInfo["prodDesc"], dt))
+        self.runlog.write("\t[INFO]: Collecting {} files for {} simulation...\n".format(productInfo["prodDesc"], dt))
         
-        for f in fileList:
+        for f in fList:
             m = re.match(productInfo['preFix'],f)
             if(m):      # found a current product file
                 productList.append(f)
@@ -353,42 +664,55 @@ class processManager(object):
         If we DO NOT have the expected number of files for this product, log a warning message
         """
         if len(productList) != productInfo["nFiles"]:
-            runlog.write("\t\t[WARN]: Got {} files, expected {} for {} on {}\n".format(len(productList), productInfo["nFiles"], productInfo["prodDesc"],dt))
+            self.runlog.write("\t\t[WARN]: Got {} files, expected {} for {} on {}\n".format(len(productList), productInfo["nFiles"], productInfo["prodDesc"],dt))
         else:
-            runlog.write("\t\t[STAT]: OK\n")
+            self.runlog.write("\t\t[STAT]: OK\n")
             
         productList.sort()
         return(productList)
 
 class dbManager(object):
 
-    def __init__(self):
+    def __init__(self, runMgr, runlog):
+        self.runMgr = runMgr
+        self.runlog = runlog
         self.mkConnection()
         self.testConnection()
     
     def mkConnection(self):
-        runlog.write("\t[INFO]: Establishing PyMongo client connection to remote database...\n")
-        un = runMgr.getDBuname()
-        pw = runMgr.getDBpword()
+        self.runlog.write("\t[INFO]: Establishing PyMongo client connection to remote database...\n")
+        un = self.runMgr.getDBuname()
+        pw = self.runMgr.getDBpword()
 
         try:
             self.pmc = MongoClient('mongodb://%s:%s@api.asrc.albany.edu/aqfcst'%(un,pw))
-        except ConnectionError:
-            runlog.write("\t\t[STAT]: Couldn't establish client connection, aborting.\n")
-            print("\t***ERROR: Could not make connection to remote MongoDB instance\n".format)
-            raise SystemExit
+        except PyMongoError as e:
+            self.runlog.write("\t\t[STAT]: Couldn't establish client connection, aborting.\n")
+            raise aqfcdbError("\t***ERROR: Could not make connection to remote MongoDB instance ({})\n".format(e))
+
+    """
+      dbError : Log a failed database operation and return the aqfcdbError to raise for it, so that
+      an unreachable or failing database stops the run the same way as any other error
+    """
+    def dbError(self, what, e):
+        self.runlog.write("\t\t[STAT]: Database error while {} - {}\n".format(what, e))
+        return(aqfcdbError("\t***ERROR: Database error while {} ({})\n".format(what, e)))
         
     def testConnection(self):
-        runlog.write("\t[INFO]: Checking PyMongo client connection to remote database...\n")
+        self.runlog.write("\t[INFO]: Checking PyMongo client connection to remote database...\n")
         db = self.pmc.aqfcst
         col = db.testcoll
 
-        if col.count_documents({}) == 0:
-            runlog.write("\t\t[STAT]: Couldn't retrieve documents from test collection.\n")
-            print("\t***ERROR: Could not retrieve documents from test collection\n".format)
-            raise SystemExit
+        try:
+            nDocs = col.count_documents({})
+        except PyMongoError as e:
+            raise self.dbError("checking the connection", e)
+
+        if nDocs == 0:
+            self.runlog.write("\t\t[STAT]: Couldn't retrieve documents from test collection.\n")
+            raise aqfcdbError("\t***ERROR: Could not retrieve documents from test collection\n")
         
-        runlog.write("\t\t[STAT]: Ok.\n")
+        self.runlog.write("\t\t[STAT]: Ok.\n")
 
     def upsertDocuments(self, fcDocument):
 
@@ -397,10 +721,11 @@ class dbManager(object):
         # the database
         db = self.pmc.aqfcst
 
-        runlog.write("\t[INFO]: Upserting forecast document in database for {}...\n".format(fcDocument['runDate']))
+        self.runlog.write("\t[INFO]: Upserting forecast document in database for {}...\n".format(fcDocument['runDate']))
         coll = db["aq_forecasts"]
 
-        coll.update_one (
+        try:
+            prevDocument = coll.find_one_and_update (
                 { "runDate": fcDocument["runDate"] },
                 { "$set":
                     { "runDate" : fcDocument["runDate"],
@@ -418,8 +743,22 @@ class dbManager(object):
                       "t"       : fcDocument["t"]
                     }
                 },
-                upsert=True
+                projection={"_id":0},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
             )
+        except PyMongoError as e:
+            raise self.dbError("upserting forecast {}".format(fcDocument["runDate"]), e)
+
+        # Return the fields that differ from what was stored before (all of them for a new document)
+        # so the caller can tell forecast consumers what changed
+        if prevDocument is None:
+            prevDocument = {}
+        changed = {}
+        for key in fcDocument:
+            if key not in prevDocument or prevDocument[key] != fcDocument[key]:
+                changed[key] = fcDocument[key]
+        return(changed)
 
     """
       Get the current number of forecast day directories stored on local disk
@@ -427,7 +766,10 @@ class dbManager(object):
     def getNumLocalDays(self):
         db = self.pmc.aqfcst
         coll = db["local_disk_info"]
-        document = coll.find_one({},{"_id":0})
+        try:
+            document = coll.find_one({},{"_id":0})
+        except PyMongoError as e:
+            raise self.dbError("reading numDaysLocal", e)
         return(document["numDaysLocal"])
     
     """
@@ -436,38 +778,359 @@ class dbManager(object):
     def setNumLocalDays(self, ndsVal):
         db = self.pmc.aqfcst
         coll = db["local_disk_info"]
-        coll.update_one(
-            {},
-            { "$set" :
-                 { "numDaysLocal" : ndsVal }
-            }
-        )
+        try:
+            coll.update_one(
+                {},
+                { "$set" :
+                     { "numDaysLocal" : ndsVal }
+                }
+            )
+        except PyMongoError as e:
+            raise self.dbError("updating numDaysLocal", e)
 
     """
       When a forecast directory is removed from local disk, this function is called
       to update the 'onDisk' status to 'False' for the corresponding forecast document
-      in the database. 'rDate' is the forecast run date.
+      in the database. 'rDate' is the forecast run date.  Returns the updated document
+      (None if there is no forecast document for 'rDate').
     """
     def setOnDiskStatus(self, rDate):
         db = self.pmc.aqfcst
         coll = db["aq_forecasts"]
-        coll.update_one(
-            { "runDate": rDate },
-            { "$set" :
-                 { "onDisk" : False }
-            }
-        )
-        
+        try:
+            return(coll.find_one_and_update(
+                { "runDate": rDate },
+                { "$set" :
+                     { "onDisk" : False }
+                },
+                projection={"_id":0},
+                return_document=ReturnDocument.AFTER
+            ))
+        except PyMongoError as e:
+            raise self.dbError("updating onDisk for {}".format(rDate), e)
+
+class leaseLostError(aqfcdbError):
+    """
+      Raised when a lease we were working under turns out to have been taken over by another worker
+    """
+    pass
+
+class leaseManager(object):
+
+    def __init__(self, runMgr, dbMgr, runlog):
+        """
+          owner   : Unique identifier for this worker (host:pid:run timestamp:instance)
+          backend : "mongo" (shared across hosts) or "file" (local host only)
+          ttl     : # of seconds a lease is valid for before another worker may take it over
+          held    : Leases currently held by this worker, lease name -> { "lockfh": open lock file,
+                    "mongo": True if also held in Mongo, "expiresAt": when the Mongo lease runs out }
+        """
+        self.dbMgr   = dbMgr
+        self.runlog  = runlog
+        self.owner   = "{}:{}:{}:{}".format(socket.gethostname(), os.getpid(), runMgr.getDTstring(), id(self))
+        self.backend = runMgr.getLeaseBackend()
+        self.ttl     = runMgr.getLeaseTTL()
+        self.lockDir = runMgr.getLockDir()
+        self.held    = {}
+
+        if self.backend not in ("mongo", "file"):
+            raise aqfcdbError("\t***ERROR: Unknown lease backend ({}), check JSON config file\n".format(self.backend))
+
+    """
+      acquire : Attempt to take the lease 'name'.  If 'wait' is > 0, keep retrying for up to
+      'wait' seconds before giving up.  Returns True if this worker now holds the lease.
+    """
+    def acquire(self, name, wait=0):
+        deadline = time.time() + wait
+        while True:
+            ok = self.tryAcquire(name)
+            if ok or time.time() >= deadline:
+                return(ok)
+            time.sleep(5)
+
+    """
+      tryAcquire : A lease is always a local file lock, so overlapping runs on this host exclude each
+      other even without the database.  With the Mongo backend the Mongo lease is taken as well, for
+      workers on other hosts.  If Mongo can't be reached we fail closed (don't take the lease), since a
+      worker on another host may still hold it there.
+    """
+    def tryAcquire(self, name):
+        if name in self.held:
+            return(True)
+
+        lockfh = self.fileLock(name)
+        if lockfh is None:
+            return(False)
+
+        lease = { "lockfh": lockfh, "mongo": False, "expiresAt": None }
+        if self.backend == "mongo":
+            try:
+                lease["expiresAt"] = self.mongoAcquire(name)
+            except PyMongoError as e:
+                self.runlog.write("\t\t[WARN]: Mongo unavailable, not taking lease {} ({})\n".format(name, e))
+            if lease["expiresAt"] is None:
+                self.fileUnlock(lockfh)
+                return(False)
+            lease["mongo"] = True
+
+        self.held[name] = lease
+        return(True)
+
+    """
+      mongoAcquire : A lease document is keyed on the lease name.  The update only matches if the
+      lease is already ours or has expired (stale lease of a crashed worker); otherwise the upsert
+      tries to insert a second document with the same '_id' and fails with a DuplicateKeyError,
+      meaning another worker holds the lease.  Returns the lease expiration, or None if not acquired.
+    """
+    def mongoAcquire(self, name):
+        coll = self.dbMgr.pmc.aqfcst["aq_leases"]
+        now = dt.datetime.utcnow()
+        expiresAt = now + dt.timedelta(seconds=self.ttl)
+        try:
+            coll.update_one(
+                { "_id": name,
+                  "$or": [ { "owner": self.owner },
+                           { "expiresAt": { "$lt": now } } ] },
+                { "$set" :
+                     { "owner"     : self.owner,
+                       "acquiredAt": now,
+                       "expiresAt" : expiresAt }
+                },
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return(None)
+
+        return(expiresAt)
+
+    """
+      fileLock : Non-blocking exclusive flock on '<lockdir>/<name>.lock'.  The OS drops the lock
+      when the process exits, so a crashed worker never leaves a stale lock behind.  Returns the
+      open lock file, or None if the lock is held elsewhere.
+    """
+    def fileLock(self, name):
+        try:
+            os.makedirs(self.lockDir, exist_ok=True)
+            lockfh = open(os.path.join(self.lockDir, name + ".lock"), 'a+')
+        except OSError as e:
+            self.runlog.write("\t\t[SERIOUS]: Could not open lock file for {} - {}\n".format(name, e.strerror))
+            return(None)
+
+        try:
+            fcntl.flock(lockfh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lockfh.close()
+            return(None)
+
+        return(lockfh)
+
+    def fileUnlock(self, lockfh):
+        fcntl.flock(lockfh, fcntl.LOCK_UN)
+        lockfh.close()
+
+    """
+      renew : Push the expiration of every Mongo lease we hold out by another 'ttl' seconds.  Call
+      this periodically during long running steps (e.g. copying forecasts) so our leases don't
+      expire underneath us.  A lease that was taken over by another worker, or that ran out while
+      Mongo was unreachable, is dropped; callers must check 'isHeld' afterwards before going on.
+    """
+    def renew(self):
+        now = dt.datetime.utcnow()
+        for name in list(self.held):
+            if not self.held[name]["mongo"]:
+                continue
+            expiresAt = now + dt.timedelta(seconds=self.ttl)
+            try:
+                res = self.dbMgr.pmc.aqfcst["aq_leases"].update_one(
+                    { "_id": name, "owner": self.owner },
+                    { "$set" :
+                         { "expiresAt" : expiresAt }
+                    }
+                )
+            except PyMongoError as e:
+                self.runlog.write("\t\t[WARN]: Could not renew lease {} ({})\n".format(name, e))
+                if now >= self.held[name]["expiresAt"]:
+                    self.runlog.write("\t\t[WARN]: Lease {} expired while Mongo was unavailable\n".format(name))
+                    self.fileUnlock(self.held.pop(name)["lockfh"])
+                continue
+            if res.matched_count == 0:
+                self.runlog.write("\t\t[WARN]: Lease {} was lost to another worker\n".format(name))
+                self.fileUnlock(self.held.pop(name)["lockfh"])
+            else:
+                self.held[name]["expiresAt"] = expiresAt
+
+    def isHeld(self, name):
+        return(name in self.held)
+
+    def release(self, name):
+        if name not in self.held:
+            return
+        lease = self.held.pop(name)
+        if lease["mongo"]:
+            try:
+                self.dbMgr.pmc.aqfcst["aq_leases"].delete_one({ "_id": name, "owner": self.owner })
+            except PyMongoError as e:
+                self.runlog.write("\t\t[WARN]: Could not release lease {} ({}), it will expire\n".format(name, e))
+        self.fileUnlock(lease["lockfh"])
+
+    def releaseAll(self):
+        for name in list(self.held):
+            self.release(name)
+
+class eventManager(object):
+
+    def __init__(self, runMgr, dbMgr, runlog):
+        """
+          sink   : Where forecast change events are delivered
+                     "mongo"   - capped collection 'aq_forecast_events' (consumers use a tailable cursor)
+                     "webhook" - HTTP POST of the JSON event to the URL in 'eventtarget'
+                     "socket"  - JSON event line written to the Unix socket path in 'eventtarget'
+                     "none"    - don't publish events
+          target : Webhook URL or Unix socket path (unused for "mongo" and "none")
+        """
+        self.runMgr = runMgr
+        self.dbMgr  = dbMgr
+        self.runlog = runlog
+        self.sink   = runMgr.getEventSink()
+        self.target = runMgr.getEventTarget()
+
+        if self.sink == "mongo":
+            self.mkEventCollection()
+        elif self.sink == "webhook":
+            if urllib.parse.urlparse(self.target).scheme not in ("http", "https"):
+                raise aqfcdbError("\t***ERROR: Event sink is webhook but eventtarget ({}) is not an http(s) URL, check JSON config file\n".format(self.target))
+        elif self.sink == "socket":
+            if not self.target:
+                raise aqfcdbError("\t***ERROR: Event sink is socket but no eventtarget socket path is set, check JSON config file\n")
+        elif self.sink != "none":
+            raise aqfcdbError("\t***ERROR: Unknown event sink ({}), check JSON config file\n".format(self.sink))
+
+    """
+      mkEventCollection : Create the capped event collection if it doesn't already exist.  Being
+      capped, old events roll off on their own and consumers can tail it for new ones.  If we can't
+      (e.g. the database user isn't allowed to create collections), events are turned off rather
+      than stopping the pipeline.
+    """
+    def mkEventCollection(self):
+        db = self.dbMgr.pmc.aqfcst
+        try:
+            db.create_collection("aq_forecast_events", capped=True, size=self.runMgr.getEventCapSize())
+        except CollectionInvalid:
+            pass    # already exists
+        except PyMongoError as e:
+            self.runlog.write("\t\t[WARN]: Could not create event collection ({}), not publishing events\n".format(e))
+            self.sink = "none"
+
+    """
+      publish : Deliver a forecast change event.  'evtType' is "upserted" or "purged", 'changed'
+      holds only the document fields that changed.  A failed delivery is logged but never aborts
+      the run, the database itself is still the source of truth.
+    """
+    def publish(self, evtType, rDate, simStat, changed):
+        if self.sink == "none":
+            return
+
+        event = {
+            "event"      : evtType,
+            "runDate"    : rDate,
+            "simStat"    : simStat,
+            "changed"    : changed,
+            "publishedAt": dt.datetime.now().replace(microsecond=0).isoformat('T')
+        }
+
+        self.runlog.write("\t\t[INFO]: Publishing {} event for {} ({})...\n".format(evtType, rDate, ", ".join(sorted(changed))))
+        try:
+            if self.sink == "mongo":
+                self.dbMgr.pmc.aqfcst["aq_forecast_events"].insert_one(event)
+            elif self.sink == "webhook":
+                self.sendWebhook(event)
+            else:
+                self.sendSocket(event)
+        except Exception as e:
+            # Anything can go wrong talking to a consumer (bad responses, encoding, ...), none of it
+            # may stop the remaining forecast documents from being written
+            self.runlog.write("\t\t[WARN]: Could not publish {} event for {} - {}: {}\n".format(evtType, rDate, type(e).__name__, e))
+
+    def sendWebhook(self, event):
+        req = urllib.request.Request(self.target,
+                                     data=json.dumps(event).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            resp.read()
+
+    def sendSocket(self, event):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(10)
+            sock.connect(self.target)
+            sock.sendall((json.dumps(event) + "\n").encode("utf-8"))
+
 class fileManager(object):
 
-    def __init__(self):
+    def __init__(self, runMgr, dbMgr, leaseMgr, evtMgr, ioMgr, runlog):
         """
           maxDaysToStore : Maximum number of forecast days (directories of files) to save on local disk
           nDaysStored    : The current number of forecast days on disk (loaded from database on 
                            initialization, and updated upon end of file manager tasks
         """
-        self.maxDaysToStore = runMgr.getMaxToStore()
-        self.nDaysStored = dbMgr.getNumLocalDays()
+        self.runMgr   = runMgr
+        self.dbMgr    = dbMgr
+        self.leaseMgr = leaseMgr
+        self.evtMgr   = evtMgr
+        self.ioMgr    = ioMgr
+        self.runlog   = runlog
+        self.maxDaysToStore = self.runMgr.getMaxToStore()
+        self.nDaysStored = self.dbMgr.getNumLocalDays()
+
+    """
+     refreshNumLocalDays : Recount the number of forecast days on local disk.  Another worker may
+     have purged or copied forecasts since we were initialized, or crashed part way through a copy,
+     so we don't trust the 'numDaysLocal' counter.  The count is the 'YYYYMMDD' directories in the
+     web directory, plus the new forecasts other workers are copying right now ('YYYYMMDD.part' with
+     their run date lease held, space they already reserved).  Leftovers of crashed workers
+     ('YYYYMMDD.part' or '.old' with nobody holding the run date) are removed.  Must be called once
+     the retention lease is held, before any of the space checks below.
+    """
+    def refreshNumLocalDays(self):
+        basePath = self.runMgr.getwebdirroot()
+        dirList  = os.listdir(basePath)
+        nDays    = 0
+        for dirName in dirList:
+            if dirName.isdigit():
+                nDays = nDays + 1
+                continue
+            rDate = dirName.split(".")[0]
+            if not rDate.isdigit() or self.leaseMgr.isHeld("rundate." + rDate):
+                continue    # not a forecast directory, or our own run date (copyForecast cleans it up)
+            if self.lockIdleDate(rDate):
+                self.runlog.write("\t\t[WARN]: Removing {} left behind by a crashed worker\n".format(dirName))
+                shutil.rmtree(os.path.join(basePath, dirName), ignore_errors=True)
+                self.leaseMgr.release("rundate." + rDate)
+            elif dirName.endswith(".part") and rDate not in dirList:
+                nDays = nDays + 1
+
+        stored = self.dbMgr.getNumLocalDays()
+        if stored != nDays:
+            self.runlog.write("\t\t[WARN]: numDaysLocal was {}, but {} forecast days are on local disk, correcting\n".format(stored, nDays))
+        self.nDaysStored = nDays
+
+    """
+     lockIdleDate : Take the run date lease for 'rDate' if no worker (including this one) is working
+     on that run date.  Returns True if we took it, the caller must release it when done.
+    """
+    def lockIdleDate(self, rDate):
+        lease = "rundate." + rDate
+        if self.leaseMgr.isHeld(lease):
+            return(False)
+        return(self.leaseMgr.acquire(lease))
+
+    """
+     ckRetention : Renew our leases and make sure we still hold the retention lease before touching
+     the local disk or 'numDaysLocal'.  If another worker has taken it over we must stop right away.
+    """
+    def ckRetention(self):
+        self.leaseMgr.renew()
+        if not self.leaseMgr.isHeld("retention"):
+            raise leaseLostError("retention")
 
     """
      ckBndryCondition : Check condition where user reduced the size of 'maxdaystostore' in the JSON
@@ -479,24 +1142,26 @@ class fileManager(object):
     """
     def ckBndryCondition(self, nfcsts):
         if self.nDaysStored > self.maxDaysToStore:
-            runlog.write("\t[IMPORTANT]: # of forecast days on local disk ({}) EXCEEDS maximum # allowed ({}), purging...\n".format(self.nDaysStored, self.maxDaysToStore))
+            self.runlog.write("\t[IMPORTANT]: # of forecast days on local disk ({}) EXCEEDS maximum # allowed ({}), purging...\n".format(self.nDaysStored, self.maxDaysToStore))
             num_to_remove = self.nDaysStored - self.maxDaysToStore - nfcsts
             num_removed = self.purgeForecasts(num_to_remove)
             if num_removed < num_to_remove:
                 # This is a critical condition because we needed to remove 'num_to_remove' directories
                 # but removed LESS than what was required, which means we don't have enough room to store 
                 # the new forecasts on local disk!
-                runlog.write("\t\t[CRITICAL]: Critical Local Disk Management Issue!\n")
-                runlog.write("\t\t[CRITICAL]: Couldn't purge minimum # of forecasts - {} out of {} purged.\n".format(num_removed, num_to_remove))
-                runlog.write("\t\t[CRITICAL]: Not enough room to store new forecasts - Check config file and potential local disk issues!\n")
+                self.runlog.write("\t\t[CRITICAL]: Critical Local Disk Management Issue!\n")
+                self.runlog.write("\t\t[CRITICAL]: Couldn't purge minimum # of forecasts - {} out of {} purged.\n".format(num_removed, num_to_remove))
+                self.runlog.write("\t\t[CRITICAL]: Not enough room to store new forecasts - Check config file and potential local disk issues!\n")
                 if num_removed != 0: # some were removed, update database
                     self.nDaysStored = self.nDaysStored - num_removed
-                    dbMgr.setNumLocalDays(self.nDaysStored)
-                    raise SystemExit
+                    self.ckRetention()
+                    self.dbMgr.setNumLocalDays(self.nDaysStored)
+                    raise aqfcdbError("\t***ERROR: Couldn't purge minimum # of forecasts, not enough room on local disk\n")
             
             # Correct number of directories were purged
             self.nDaysStored = self.nDaysStored - num_removed
-            dbMgr.setNumLocalDays(self.nDaysStored)
+            self.ckRetention()
+            self.dbMgr.setNumLocalDays(self.nDaysStored)
 
     """
      checkSpace : If we get here we passed the 'ckBndryCondition' test, where at runtime
@@ -505,17 +1170,19 @@ class fileManager(object):
      to make room for the incoming forecast directories. In this function, we check whether we
      need to clear directory space in order to store the new forecasts, and if so attempt to clear
      the needed space.  The function returns the number of forecast directories that can actually
-     be stored (copied to local disk) by this run
+     be stored (copied to local disk) by this run.  'nDaysStored' is reduced by the number of
+     directories purged; the caller is responsible for saving it to the database.
     """
     def checkSpace(self, nfcsts):
         if self.nDaysStored == self.maxDaysToStore:
             # We've either been @ the maximum storage for awhile, or the user just reduced
             # it to new 'maxdaystostore' in JSON config file
-            runlog.write("\t[IMPORTANT]: # of forecast days on local disk ({}) @ maximum allowed ({}), purging...\n".format(self.nDaysStored, self.maxDaysToStore))
+            self.runlog.write("\t[IMPORTANT]: # of forecast days on local disk ({}) @ maximum allowed ({}), purging...\n".format(self.nDaysStored, self.maxDaysToStore))
             num_removed = self.purgeForecasts(nfcsts)
-            runlog.write("\t\t[INFO]: Removed {} of {} forecast directories.\n".format(num_removed, nfcsts))
+            self.nDaysStored = self.nDaysStored - num_removed
+            self.runlog.write("\t\t[INFO]: Removed {} of {} forecast directories.\n".format(num_removed, nfcsts))
             if num_removed != nfcsts:
-                return (self.maxDaysToStore - num_removed)
+                return (num_removed)
             else:
                 return (nfcsts)
         elif self.nDaysStored + nfcsts > self.maxDaysToStore:
@@ -527,10 +1194,11 @@ class fileManager(object):
             #   num_to_remove =  (nDaysStored + nfcsts) - maxDaysToStore
             #                 =  (5 + 8) - 10 == 3
             num_to_remove = (self.nDaysStored + nfcsts) - self.maxDaysToStore
-            runlog.write("\t[IMPORTANT]: # of forecasts on local disk ({}) + current # of forecasts ({}) > maximum allowed ({}), purging {}...\n"
+            self.runlog.write("\t[IMPORTANT]: # of forecasts on local disk ({}) + current # of forecasts ({}) > maximum allowed ({}), purging {}...\n"
                          .format(self.nDaysStored, nfcsts, self.maxDaysToStore, num_to_remove))
             num_removed = self.purgeForecasts(num_to_remove)
-            runlog.write("\t\t[INFO]: Removed {} of {} forecast directories.\n".format(num_removed, num_to_remove))
+            self.nDaysStored = self.nDaysStored - num_removed
+            self.runlog.write("\t\t[INFO]: Removed {} of {} forecast directories.\n".format(num_removed, num_to_remove))
             if num_removed != num_to_remove:
                 return (nfcsts - (num_to_remove - num_removed))
             else:
@@ -552,83 +1220,236 @@ class fileManager(object):
     def purgeForecasts(self, ntr):
         # 'ntr' - # of forecast day directories to remove from disk
         numRemoved = 0  # this ulimately gets returned
-        basePath = runMgr.getwebdirroot()
-        dirList  = os.listdir(basePath)
+        basePath = self.runMgr.getwebdirroot()
+        # Only forecast directories ('YYYYMMDD'), not copies still in progress ('YYYYMMDD.part')
+        dirList  = [ d for d in os.listdir(basePath) if d.isdigit() ]
         dirList.sort()  # ascending date order
-        runlog.write("\t[INFO]: Purging {} forecast directories from local disk...\n".format(ntr))
-        for d in range(ntr):
+        self.runlog.write("\t[INFO]: Purging {} forecast directories from local disk...\n".format(ntr))
+        while numRemoved < ntr and len(dirList) > 0:
             # Note that 'dirName' is in 'YYYYMMDD' format which corresponds nicely with forecast run date
             dirName = dirList.pop(0)
-            runlog.write("\t\t[INFO]: Removing forecast directory {} from local disk...\n".format(dirName))
+            self.ckRetention()
+            # A worker working on this run date would write 'onDisk' back to True after we remove it
+            if not self.lockIdleDate(dirName):
+                self.runlog.write("\t\t[INFO]: Forecast {} is in use by a worker, not removing it.\n".format(dirName))
+                continue
+            self.runlog.write("\t\t[INFO]: Removing forecast directory {} from local disk...\n".format(dirName))
             try:
-                shutil.rmtree(basePath+dirName)
-                runlog.write("\t\t[STAT]: Ok.\n")
+                shutil.rmtree(os.path.join(basePath, dirName))
+                self.runlog.write("\t\t[STAT]: Ok.\n")
                 numRemoved = numRemoved + 1
-                dbMgr.setOnDiskStatus(dirName)    # Update onDisk status to False for removed forecast
+                fcDocument = self.dbMgr.setOnDiskStatus(dirName)    # Update onDisk status to False for removed forecast
+                if fcDocument is not None:
+                    self.evtMgr.publish("purged", dirName, fcDocument["simStat"], { "onDisk" : False })
             except OSError as e:
-                runlog.write("\t\t[STAT]: Error: {} - {}\n".format(e.filename, e.strerror))
+                self.runlog.write("\t\t[STAT]: Error: {} - {}\n".format(e.filename, e.strerror))
+            finally:
+                self.leaseMgr.release("rundate." + dirName)
         
-        runlog.write("\t[STAT]: Removed {} of {} forecast directories...\n".format(numRemoved, ntr))
+        self.runlog.write("\t[STAT]: Removed {} of {} forecast directories...\n".format(numRemoved, ntr))
         return(numRemoved)
 
     """
-     copyForecasts : Given the number of forecast dates/directories that CAN be copied to local disk (mind you
-     this could be LESS than the number of new forecasts we want to copy to the local space), attempt to copy
-     the directories from NetAPP to local disk. The function works on the global list of forecast collections
-     'FC_Collection' which is now sorted in ascending order by "runDate". If there is any problem tyring to copy
-     a forecast from NetApp to local disk, we will return immediately since we don't want to try to copy any 
-     subsequent forecasts to local disk.
-    """
-    def copyForecasts(self, ntc):
-        runlog.write("\t[INFO] Copying {} of {} forecasts from NetApp to Local Disk...\n".format(ntc, len(FC_Collection)))
-        num_copied_ok = 0
-        for n in range (ntc):
-            targetDir = os.path.join(runMgr.getwebdirroot(), FC_Collection[n]["runDate"])
-            srcDirnm  = runMgr.getRunPrefix() + FC_Collection[n]["runDate"] + runMgr.getRunSuffix()
-            sourceDir = os.path.join(runMgr.getnetapproot(), srcDirnm)
-            try:
-                shutil.copytree(sourceDir, targetDir, dirs_exist_ok=False)
-            except OSError as e:
-                runlog.write("\t\t[SERIOUS] Error {} - {}\n".format(e.filename, e.strerror))
-                return(num_copied_ok)
+     storeForecast : Copy one forecast from NetApp to local disk, setting its 'onDisk' flag.  'fList' is
+     the NetApp listing of the forecast.  A forecast already on local disk is copied again (no new
+     space needed) if its files differ from 'fList', e.g. it was first copied while the model was still
+     writing.  For a new forecast, space is made and reserved in 'numDaysLocal' under the retention
+     lease, which is only held for that short bookkeeping step; the copy itself runs under the
+     forecast's run date lease only, so workers copy different run dates in parallel.  If the copy
+     fails the reservation is given back.  Returns False
+     if the retention lease couldn't be acquired, in which case the forecast document should not be
+     written (we can't tell whether it's on disk).  Raises leaseLostError if the retention lease is
+     taken over by another worker while we're using it.
+    """
+    def storeForecast(self, fcDocument, fList):
+        rDate = fcDocument["runDate"]
+        targetDir = os.path.join(self.runMgr.getwebdirroot(), rDate)
+        if os.path.isdir(targetDir):
+            if sorted(os.listdir(targetDir)) == sorted(fList):
+                self.runlog.write("\t\t[INFO] Forecast {} is already on Local Disk.\n".format(rDate))
+            elif not self.copyForecast(rDate):
+                self.runlog.write("\t\t[WARN] Keeping out of date copy of forecast {} on Local Disk.\n".format(rDate))
+            fcDocument["onDisk"] = True
+            return(True)
+
+        if not self.leaseMgr.acquire("retention", wait=self.runMgr.getLeaseWait()):
+            # Another worker has been managing local disk storage for longer than we're willing to
+            # wait.  Leave this run date for the next run rather than risk an incorrect 'onDisk'.
+            self.runlog.write("\t[SERIOUS]: Could not acquire retention lease, skipping forecast {}.\n".format(rDate))
+            return(False)
+        try:
+            self.refreshNumLocalDays()                  # another worker may have changed it
+            self.ckBndryCondition(1)                    # special config file change case
+            ntc = self.checkSpace(1)                    # check remaining space cases
+            if ntc > 0:
+                self.nDaysStored = self.nDaysStored + 1 # reserve space for this forecast
+            self.ckRetention()
+            self.dbMgr.setNumLocalDays(self.nDaysStored)
+            if ntc < 1:
+                self.runlog.write("\t\t[SERIOUS] No room on Local Disk for forecast {}.\n".format(rDate))
+                return(True)
+        finally:
+            self.leaseMgr.release("retention")
+
+        if self.copyForecast(rDate):
+            fcDocument["onDisk"] = True
+            return(True)
+
+        # Copy failed, give back the space we reserved (our '.part' is gone, so a recount does it).
+        # If we can't, the next worker to recount will.
+        if not self.leaseMgr.acquire("retention", wait=self.runMgr.getLeaseWait()):
+            self.runlog.write("\t\t[WARN]: Could not return reserved space for {}, it will be recounted later\n".format(rDate))
+            return(True)
+        try:
+            self.refreshNumLocalDays()
+            self.ckRetention()
+            self.dbMgr.setNumLocalDays(self.nDaysStored)
+        finally:
+            self.leaseMgr.release("retention")
+        return(True)
+
+    """
+     copyForecast : Copy the forecast directory for run date 'rDate' from NetApp to local disk.  The
+     copy is made under a '.part' name and renamed into place when complete, so the web application
+     and purgeForecasts never see a partial forecast directory.  An existing copy is moved aside
+     ('.old') and removed once the new one is in place.  Returns True if the copy worked.
+    """
+    def copyForecast(self, rDate):
+        self.runlog.write("\t[INFO] Copying forecast {} from NetApp to Local Disk...\n".format(rDate))
+        targetDir = os.path.join(self.runMgr.getwebdirroot(), rDate)
+        srcDirnm  = self.runMgr.getRunPrefix() + rDate + self.runMgr.getRunSuffix()
+        sourceDir = os.path.join(self.runMgr.getnetapproot(), srcDirnm)
+        try:
+            shutil.rmtree(targetDir + ".part", ignore_errors=True)   # left over from a crashed worker
+            shutil.rmtree(targetDir + ".old", ignore_errors=True)
+            self.ioMgr.copytree(sourceDir, targetDir + ".part")
+            if os.path.isdir(targetDir):
+                os.rename(targetDir, targetDir + ".old")
+            os.rename(targetDir + ".part", targetDir)
+            shutil.rmtree(targetDir + ".old", ignore_errors=True)
+        except OSError as e:
+            self.runlog.write("\t\t[SERIOUS] Error {} - {}\n".format(e.filename, e.strerror))
+            shutil.rmtree(targetDir + ".part", ignore_errors=True)
+            if os.path.isdir(targetDir + ".old") and not os.path.isdir(targetDir):
+                os.rename(targetDir + ".old", targetDir)    # put the previous copy back
+            return(False)
+
+        # Copy seems to have worked ok for this forecast
+        self.runlog.write("\t\t[INFO] Copied forecast {} from NetApp to Local Disk.\n".format(rDate))
+        return(True)
+
+class aqfcPipeline(object):
+
+    def __init__(self, runMgr, dbMgr=None, ioMgr=None, evtMgr=None, checkPyEnv=False):
+        """
+          One pipeline object can be run any number of times inside a long lived process (our daemon,
+          Airflow, etc.) without re-reading the config or re-connecting to the database.  The managers
+          that are expensive to create or carry state between runs are created once here, unless the
+          caller passes in their own:
+            runMgr : runManager holding the configuration and database credentials (required)
+            dbMgr  : dbManager, its MongoClient (and connection pool) is reused by every run
+            ioMgr  : ioManager, its NetApp throttle state and directory cache carry across runs
+            evtMgr : eventManager used to publish forecast change events
+            checkPyEnv : Check we're running in the 'aqfcdb' conda environment (command line use only)
+          Conditions that stop a run (e.g. no model output directories yet) raise aqfcdbError, which is
+          also written to the run log; a scheduler can catch it and simply try again on its next run.
+          'close' only closes the database connection if the pipeline created it.
+        """
+        self.runMgr = runMgr
+        self.ownDB  = dbMgr is None
+        self.lock   = threading.Lock()     # runs within one process are serialized
+
+        self.runMgr.setProgramPath()
+        if not hasattr(self.runMgr, "prg_cfgdata"):
+            self.runMgr.readCfgFile()
+        self.runMgr.setLogFH()
+        self.runlog = self.runMgr.getLogFH()
+
+        if self.runMgr.getUseManFlag():
+            self.runMgr.validateMandate()
+        if self.runMgr.getNumRetro() != 0:
+            self.runMgr.validateRetro()
+        if checkPyEnv:
+            self.runMgr.validatePyEnv()
+
+        # All reads from the NetApp go through 'ioMgr' so we don't starve the model's own output
+        self.ioMgr   = ioMgr if ioMgr is not None else ioManager(self.runMgr, self.runlog)
+        self.prodMgr = productManager()
+        self.procMgr = processManager(self.runlog)
+        self.dbMgr   = dbMgr if dbMgr is not None else dbManager(self.runMgr, self.runlog)
+        self.evtMgr  = evtMgr if evtMgr is not None else eventManager(self.runMgr, self.dbMgr, self.runlog)
 
-            # Copy seems to have worked ok for this forecast
-            runlog.write("\t\t[INFO] Copied forecast {} from NetApp to Local Disk.\n".format(FC_Collection[n]["runDate"]))
-            num_copied_ok = num_copied_ok + 1
-            self.nDaysStored = self.nDaysStored + 1
-            dbMgr.setNumLocalDays(self.nDaysStored)
-            FC_Collection[n]["onDisk"] = True
+    """
+      run : Process the current set of forecast run dates once.  Returns the list of forecast
+      documents (the forecast collection) that were handled by this run.
+    """
+    def run(self):
+        with self.lock:
+            self.runMgr.setDTstamp()
+            self.runMgr.writeCfgData()
+            self.ioMgr.startRun()
+
+            # Leases keep overlapping runs (on this or other hosts) from processing the same run date, or
+            # purging/copying/updating 'numDaysLocal' at the same time.  Leases of a crashed worker expire
+            # after 'leasettl' seconds.
+            leaseMgr = leaseManager(self.runMgr, self.dbMgr, self.runlog)
+            try:
+                fcCollection = self.processDates(leaseMgr)
+            except aqfcdbError as e:
+                self.runlog.write("\t[ERROR]: {}\n".format(str(e).strip()))
+                raise
+            finally:
+                leaseMgr.releaseAll()
+                self.ioMgr.writeStats()
+                self.runlog.write("\t[STAT]: Done.\n")
+                self.runlog.flush()
+
+        return(fcCollection)
 
-        return (num_copied_ok)
-        
-######################################################################################################################
+    """
+     processDates : Each run date is handled start to finish (collect, store on local disk, update
+     the database) under its own run date lease, so concurrent workers split the run dates between
+     them: a worker skips any date another worker is working on.  Note that the file management for
+     a forecast must be completed BEFORE its database update because each forecast document needs to
+     have it's 'onDisk' flag set by the file manager.
+    """
+    def processDates(self, leaseMgr):
+        fcCollection = []    # Array list of forecast objects
 
-if __name__ == '__main__':
+        simMgr = simManager(self.runMgr, self.ioMgr, self.runlog)
+        simMgr.checkSimEnv()
 
-    FC_Collection = []    # Array list of forecast objects
-    
-    runMgr = runManager()
+        fileMgr = fileManager(self.runMgr, self.dbMgr, leaseMgr, self.evtMgr, self.ioMgr, self.runlog)
 
-    runMgr.setProgramPath()
-    runMgr.readCfgFile()
-    runMgr.setLogFH()
-    runlog = runMgr.getLogFH()
-    runMgr.writeCfgData()
-    
-    if runMgr.getUseManFlag():
-        runMgr.validateMandate()
-    if runMgr.getNumRetro() != 0:
-        runMgr.validateRetro()
-    runMgr.validatePyEnv()
-    
-    simMgr = simManager()
-    simMgr.checkSimEnv()
-    
-    prodMgr = productManager()
-    procMgr = processManager()
+        # Loop over all the forecast dates, oldest to newest
+        dateList = sorted(simMgr.getFinalList())
+        for d in range (len(dateList)):
+            lease = "rundate." + dateList[d]
+            # Only process run dates no other worker is currently processing
+            if not leaseMgr.acquire(lease):
+                self.runlog.write("\t[INFO]: Run date {} is leased by another worker, skipping...\n".format(dateList[d]))
+                continue
 
-    dbMgr   = dbManager()
-    fileMgr = fileManager()
+            try:
+                fList = self.ioMgr.listdir(simMgr.getFullPath(dateList[d]))
+                fcDocument = self.collectForecast(fList, dateList[d])
+                if not fileMgr.storeForecast(fcDocument, fList):
+                    continue
+
+                # Update/Insert the forecast document into the database, if it's still ours to update
+                leaseMgr.renew()
+                if not leaseMgr.isHeld(lease):
+                    raise leaseLostError(lease)
+                changed = self.dbMgr.upsertDocuments(fcDocument)
+                if changed:
+                    self.evtMgr.publish("upserted", fcDocument["runDate"], fcDocument["simStat"], changed)
+                fcCollection.append(fcDocument)
+            except leaseLostError as e:
+                self.runlog.write("\t[SERIOUS]: Lost lease {} to another worker, not updating forecast {}.\n".format(e, dateList[d]))
+            finally:
+                leaseMgr.release(lease)
+
+        return(fcCollection)
 
     """
     Note: A forecast collection is a simulation date document.  There could be partial product
@@ -638,63 +1459,60 @@ if __name__ == '__main__':
     "expected number of files for each product" check.  May have to revisit this design if web
     application demands it.
     """
-    # Loop over all the forecast dates
-    dateList = simMgr.getFinalList()
-    for d in range (len(dateList)):
-        fileList = os.listdir(simMgr.getFullPath(dateList[d]))
+    def collectForecast(self, fList, rDate):
         simStatus = "NORMAL"  # assume everything ok at first
         simMsg    = ""
         
         p_o31hr = []
-        p_o31hr = procMgr.collectProduct(prodMgr.getO31hr(), fileList, dateList[d])
-        if len(p_o31hr) != prodMgr.getO31hr()["nFiles"]:
+        p_o31hr = self.procMgr.collectProduct(self.prodMgr.getO31hr(), fList, rDate)
+        if len(p_o31hr) != self.prodMgr.getO31hr()["nFiles"]:
             simStatus = "ALERT"
             simMsg = simMsg + "O31HR incomplete # of products\n"
             
         p_o38hr = []
-        p_o38hr = procMgr.collectProduct(prodMgr.getO38hr(), fileList, dateList[d])
-        if len(p_o38hr) != prodMgr.getO38hr()["nFiles"]:
+        p_o38hr = self.procMgr.collectProduct(self.prodMgr.getO38hr(), fList, rDate)
+        if len(p_o38hr) != self.prodMgr.getO38hr()["nFiles"]:
             simStatus = "ALERT"
             simMsg = simMsg + "O38HR incomplete # of products\n"
         
         p_pm251hr = []
-        p_pm251hr = procMgr.collectProduct(prodMgr.getPM251hr(), fileList, dateList[d])
-        if len(p_pm251hr) != prodMgr.getPM251hr()["nFiles"]:
+        p_pm251hr = self.procMgr.collectProduct(self.prodMgr.getPM251hr(), fList, rDate)
+        if len(p_pm251hr) != self.prodMgr.getPM251hr()["nFiles"]:
             simStatus = "ALERT"
             simMsg = simMsg + "PM25HR incomplete # of products\n"
         
         p_pm2524hr = []
-        p_pm2524hr = procMgr.collectProduct(prodMgr.getPM2524hr(), fileList, dateList[d])
-        if len(p_pm2524hr) != prodMgr.getPM2524hr()["nFiles"]:
+        p_pm2524hr = self.procMgr.collectProduct(self.prodMgr.getPM2524hr(), fList, rDate)
+        if len(p_pm2524hr) != self.prodMgr.getPM2524hr()["nFiles"]:
             simStatus = "ALERT"
             simMsg = simMsg + "PM2524HR incomplete # of products\n"
 
         p_dmax = []
-        p_dmax = procMgr.collectProduct(prodMgr.getDMAX(), fileList, dateList[d])
-        if len(p_dmax) != prodMgr.getDMAX()["nFiles"]:
+        p_dmax = self.procMgr.collectProduct(self.prodMgr.getDMAX(), fList, rDate)
+        if len(p_dmax) != self.prodMgr.getDMAX()["nFiles"]:
             simStatus = "ALERT"
             simMsg = simMsg + "DMAX incomplete # of products\n"
 
         
         p_eval = []
-        p_eval = procMgr.collectProduct(prodMgr.getEVAL(), fileList, dateList[d])
-        if len(p_eval) != prodMgr.getEVAL()["nFiles"]:
+        p_eval = self.procMgr.collectProduct(self.prodMgr.getEVAL(), fList, rDate)
+        if len(p_eval) != self.prodMgr.getEVAL()["nFiles"]:
             simStatus = "ALERT"
             simMsg = simMsg + "Evaluation incomplete # of products\n"
         
         p_t = []
-        p_t = procMgr.collectProduct(prodMgr.getT(), fileList, dateList[d])
-        if len(p_t) != prodMgr.getT()["nFiles"]:
+        p_t = self.procMgr.collectProduct(self.prodMgr.getT(), fList, rDate)
+        if len(p_t) != self.prodMgr.getT()["nFiles"]:
             simStatus = "ALERT"
             simMsg = simMsg + "T incomplete # of products\n"
             
-        FC_Collection.append(
-            { "runDate" : dateList[d],
+        return(
+            { "runDate" : rDate,
               "simStat" : simStatus,
               "simMsg"  : simMsg,
               "onDisk"  : False,
-              "netApp"  : runMgr.getnetapproot(),
-              "webDir"  : runMgr.getwebdirroot(),
+              "netApp"  : self.runMgr.getnetapproot(),
+              "webDir"  : self.runMgr.getwebdirroot(),
               "o31hr"   : p_o31hr,
               "o38hr"   : p_o38hr,
               "pm251hr" : p_pm251hr,
@@ -705,27 +1523,29 @@ if __name__ == '__main__':
             }
         )
 
-    """
-     Must have at least 1 forecast document to commit to database and store
-     to local disk.  Note that the file management process must be completed BEFORE
-     the database update because each forecast document needs to have it's 'onDisk'
-     flag set and 'offDiskReason' (if it's onDisk flag is "false") determined by 
-     the file manager, AND, we need to determine how many of the current forecasts
-     can actually be copied to local disk in the event there is a problem purging
-     the minimum # of existing directories
-    """
-    if (len(FC_Collection) > 0):
+    def close(self):
+        if self.ownDB:
+            self.dbMgr.pmc.close()
+        self.runlog.close()
 
-        # Handle file management tasks for local storage (for web application).
-        fileMgr.ckBndryCondition(len(FC_Collection))          # special config file change case
-        num_to_copy = fileMgr.checkSpace(len(FC_Collection))  # check remaining space cases
-        FC_Collection.sort(key=lambda x: x["runDate"])        # Get forecasts in order oldest to newest
-        num_copied = fileMgr.copyForecasts(num_to_copy)
-        runlog.write("\t\t[INFO] Copied {} of {}.\n".format(num_copied, num_to_copy))
-        
-        # Update/Insert the current forecast documents into the database
-        for f in range(len(FC_Collection)):
-            dbMgr.upsertDocuments(FC_Collection[f])
+def getCmdLineArgs():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cfgfile", help="Your input configuration File (JSON format)", type=str)
+    parser.add_argument("-u", "--uname", help="Remote database username",type=str)
+    parser.add_argument("-p", "--pword", help="Remote database password",type=str)
+    return(parser.parse_args())
+
+######################################################################################################################
+
+if __name__ == '__main__':
+
+    args = getCmdLineArgs()
+    runMgr = runManager(args.cfgfile, args.uname, args.pword)
 
-    runlog.write("\t[STAT]: Done.\n")
-    runMgr.getLogFH().close()
+    try:
+        pipeline = aqfcPipeline(runMgr, checkPyEnv=True)
+        pipeline.run()
+        pipeline.close()
+    except aqfcdbError as e:
+        print(e)
+        raise SystemExit